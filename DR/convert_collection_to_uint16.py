@@ -0,0 +1,34 @@
+import os
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+def cvt_collection_to_uint16(args):
+    # BERT vocab (30522) fits into uint16, which halves the size of token_ids.memmap
+    pids = np.memmap(f"{args.collection_memmap_dir}/pids.memmap", dtype='int32',)
+    collection_size, max_seq_length = len(pids), 512
+    src = np.memmap(f"{args.collection_memmap_dir}/token_ids.memmap", dtype='int32',
+        mode='r', shape=(collection_size, max_seq_length))
+    # CollectionDataset uses the u16 file as soon as it exists, so only a complete 
+    # conversion is moved onto the final name
+    dst_path = f"{args.collection_memmap_dir}/token_ids.u16.memmap"
+    dst = np.memmap(f"{dst_path}.tmp", dtype='uint16',
+        mode='w+', shape=(collection_size, max_seq_length))
+
+    for begin in tqdm(range(0, collection_size, args.chunk_size), desc="collection"):
+        chunk = src[begin:begin+args.chunk_size]
+        assert chunk.min() >= 0 and chunk.max() <= np.iinfo(np.uint16).max
+        dst[begin:begin+args.chunk_size] = chunk.astype(np.uint16, copy=False)
+    dst.flush()
+    del dst
+    os.replace(f"{dst_path}.tmp", dst_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collection_memmap_dir", type=str, default="./data/collection_memmap")
+    parser.add_argument("--chunk_size", type=int, default=100000)
+    args = parser.parse_args()
+
+    assert os.path.exists(args.collection_memmap_dir)
+    cvt_collection_to_uint16(args)
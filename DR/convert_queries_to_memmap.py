@@ -0,0 +1,43 @@
+import os
+import argparse
+import numpy as np
+from tqdm import tqdm
+from transformers import BertTokenizerFast
+
+def cvt_queries_to_memmap(args, tokenizer):
+    qids, texts = [], []
+    for line in tqdm(open(args.queries), desc=f"Load: {os.path.basename(args.queries)}"):
+        qid, text = line.rstrip("\n").split("\t")
+        qids.append(int(qid))
+        texts.append(text)
+    all_ids = tokenizer(texts, add_special_tokens=False,
+        return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+    offsets = np.zeros(len(qids)+1, dtype='int64')
+    offsets[1:] = np.cumsum([len(ids) for ids in all_ids])
+
+    prefix = f"{args.output_dir}/queries.{args.mode}"
+    qids_memmap = np.memmap(f"{prefix}.qids.memmap", dtype='int32',
+        mode='w+', shape=(len(qids),))
+    offsets_memmap = np.memmap(f"{prefix}.offsets.memmap", dtype='int64',
+        mode='w+', shape=(len(offsets),))
+    token_ids = np.memmap(f"{prefix}.token_ids.memmap", dtype='int32',
+        mode='w+', shape=(max(offsets[-1], 1),))
+    qids_memmap[:] = qids
+    offsets_memmap[:] = offsets
+
+    for idx, ids in enumerate(tqdm(all_ids, desc="queries")):
+        token_ids[offsets[idx]:offsets[idx+1]] = ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=str,
+        default="./data/msmarco-passage/queries.train.tsv")
+    parser.add_argument("--mode", type=str, default="train")
+    parser.add_argument("--output_dir", type=str, default="./data/queries_memmap")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
+    cvt_queries_to_memmap(args, tokenizer)
@@ -1,57 +1,72 @@
 import os
+import re
+import csv
 import math
+import mmap
 import json
 import torch
 import logging
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
-from collections import namedtuple, defaultdict
-from transformers import BertTokenizer
-from torch.utils.data import Dataset
+from collections import namedtuple
+from transformers import BertTokenizerFast
+from torch.utils.data import Dataset, Sampler
 import random
+import string
 
-from textattack.transformations import WordSwapNeighboringCharacterSwap, \
-    WordSwapRandomCharacterDeletion, WordSwapRandomCharacterInsertion, \
-    WordSwapRandomCharacterSubstitution, WordSwapQWERTY
-from textattack.augmentation import Augmenter
-from textattack.transformations import CompositeTransformation
-from textattack.constraints.pre_transformation.min_word_length import MinWordLength
-
-class FixWordSwapQWERTY(WordSwapQWERTY):
-    def _get_replacement_words(self, word):
-        if len(word) <= 1:
-            return []
-
-        candidate_words = []
-
-        start_idx = 1 if self.skip_first_char else 0
-        end_idx = len(word) - (1 + self.skip_last_char)
-
-        if start_idx >= end_idx:
-            return []
-
-        if self.random_one:
-            i = random.randrange(start_idx, end_idx + 1)
-            if len(self._get_adjacent(word[i])) == 0:
-                candidate_word = (
-                    word[:i] + random.choice(list(self._keyboard_adjacency.keys())) + word[i + 1:]
-                )
-            else:
-                candidate_word = (
-                    word[:i] + random.choice(self._get_adjacent(word[i])) + word[i + 1:]
-                )
-            candidate_words.append(candidate_word)
-        else:
-            for i in range(start_idx, end_idx + 1):
-                for swap_key in self._get_adjacent(word[i]):
-                    candidate_word = word[:i] + swap_key + word[i + 1 :]
-                    candidate_words.append(candidate_word)
-
-        return candidate_words
 
 logger = logging.getLogger(__name__)
 
 
+QWERTY_ADJACENCY = {
+    "q": "was", "w": "qeasd", "e": "wsdfr", "r": "edfgt", "t": "rfghy",
+    "y": "tghju", "u": "yhjki", "i": "ujklo", "o": "iklp", "p": "ol",
+    "a": "qwszx", "s": "qweadzx", "d": "werfcxs", "f": "ertgvcd", "g": "rtyhbvd",
+    "h": "tyugjbn", "j": "yuikmnh", "k": "uiolmj", "l": "iopk",
+    "z": "asx", "x": "sdzc", "c": "xdfv", "v": "cfgb", "b": "vghn", "n": "bhjm", "m": "njk",
+}
+
+
+def _typo_delete(word, rng):
+    i = rng.randrange(len(word))
+    return word[:i] + word[i+1:]
+
+
+def _typo_swap_neighbor(word, rng):
+    i = rng.randrange(len(word) - 1)
+    return word[:i] + word[i+1] + word[i] + word[i+2:]
+
+
+def _typo_insert(word, rng):
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i:]
+
+
+def _typo_substitute(word, rng):
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i+1:]
+
+
+def _typo_qwerty(word, rng):
+    i = rng.randrange(len(word))
+    key = rng.choice(QWERTY_ADJACENCY[word[i].lower()])
+    return word[:i] + (key.upper() if word[i].isupper() else key) + word[i+1:]
+
+
+TYPO_OPERATIONS = (_typo_delete, _typo_swap_neighbor, _typo_insert, _typo_substitute, _typo_qwerty)
+
+
+def apply_random_typo(query, rng=random):
+    """Insert one random typo into a random word of at least 3 letters."""
+    # words are letter spans, like the punctuation-stripped words textattack picked from
+    candidates = [m.span() for m in re.finditer(r"[A-Za-z]+", query) if m.end() - m.start() >= 3]
+    if len(candidates) == 0:
+        return query
+    start, end = rng.choice(candidates)
+    return query[:start] + rng.choice(TYPO_OPERATIONS)(query[start:end], rng) + query[end:]
+
+
 def read_queries(path_to_query):
     query_dict = {}
     with open(path_to_query, 'r') as f:
@@ -68,15 +83,56 @@ class CollectionDataset:
         self.pids = np.memmap(f"{collection_memmap_dir}/pids.memmap", dtype='int32',)
         self.lengths = np.memmap(f"{collection_memmap_dir}/lengths.memmap", dtype='int32',)
         self.collection_size = len(self.pids)
-        self.token_ids = np.memmap(f"{collection_memmap_dir}/token_ids.memmap", 
-                dtype='int32', shape=(self.collection_size, 512))
+        u16_path = f"{collection_memmap_dir}/token_ids.u16.memmap"
+        int32_path = f"{collection_memmap_dir}/token_ids.memmap"
+        # written by convert_collection_to_uint16.py, half the I/O of the int32 file;
+        # ignored if token_ids.memmap was regenerated after the conversion
+        if os.path.exists(u16_path) and (not os.path.exists(int32_path) or 
+                os.path.getmtime(u16_path) >= os.path.getmtime(int32_path)):
+            self.token_ids = np.memmap(u16_path, 
+                    dtype='uint16', shape=(self.collection_size, 512))
+        else:
+            self.token_ids = np.memmap(int32_path, 
+                    dtype='int32', shape=(self.collection_size, 512))
     
+    def advise_sequential(self):
+        # let the kernel read ahead aggressively when rows are visited in pid order
+        # _mmap is private to np.memmap, skip the hint if it is not there
+        token_ids_mmap = getattr(self.token_ids, "_mmap", None)
+        if token_ids_mmap is not None and hasattr(mmap, "MADV_SEQUENTIAL"):
+            token_ids_mmap.madvise(mmap.MADV_SEQUENTIAL)
+
     def __len__(self):
         return self.collection_size
 
     def __getitem__(self, item):
         assert self.pids[item] == item
-        return self.token_ids[item, :self.lengths[item]].tolist()
+        # a view of the memmap row, no copy into a python list
+        return self.token_ids[item, :self.lengths[item]]
+
+
+class QueryDataset:
+    def __init__(self, query_memmap_dir, mode):
+        self.qids = np.memmap(f"{query_memmap_dir}/queries.{mode}.qids.memmap", dtype='int32',)
+        self.offsets = np.memmap(f"{query_memmap_dir}/queries.{mode}.offsets.memmap", dtype='int64',)
+        self.token_ids = np.memmap(f"{query_memmap_dir}/queries.{mode}.token_ids.memmap", dtype='int32',)
+        # MSMARCO qids are dense enough for a direct lookup table, -1 marks unknown qids
+        self.qid2row = np.full(self.qids.max()+1, -1, dtype=np.int32)
+        self.qid2row[self.qids] = np.arange(len(self.qids), dtype=np.int32)
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.qids)
+
+    def contains(self, qids):
+        qids = np.asarray(qids)
+        in_range = (qids >= 0) & (qids < len(self.qid2row))
+        return in_range & (self.qid2row[np.where(in_range, qids, 0)] >= 0)
+
+    def __getitem__(self, qid):
+        assert 0 <= qid < len(self.qid2row) and self.qid2row[qid] >= 0, f"unknown qid {qid}"
+        row = self.qid2row[qid]
+        return self.token_ids[self.offsets[row]:self.offsets[row+1]]
 
 
 def load_queries(tokenize_dir, mode):
@@ -87,29 +143,33 @@ def load_queries(tokenize_dir, mode):
     return queries
 
 
+# CSR layout: the relevant pids of qid are indices[indptr[qid]:indptr[qid+1]]
+Qrels = namedtuple("Qrels", ["indptr", "indices"])
+
+
 def load_querydoc_pairs(msmarco_dir, mode):
-    qrels = defaultdict(set)
-    qids, pids, labels = [], [], []
     if mode == "train":
-        for line in tqdm(open(f"{msmarco_dir}/qidpidtriples.train.small.tsv"),
-                desc="load train triples"):
-            qid, pos_pid, neg_pid = line.split("\t")
-            qid, pos_pid, neg_pid = int(qid), int(pos_pid), int(neg_pid)
-            qids.append(qid)
-            pids.append(pos_pid)
-            labels.append(1)
-            qids.append(qid)
-            pids.append(neg_pid)
-            labels.append(0)
-        for line in open(f"{msmarco_dir}/qrels.train.tsv"):
-            qid, _, pid, _ = line.split()
-            qrels[int(qid)].add(int(pid))
+        triples = pd.read_csv(f"{msmarco_dir}/qidpidtriples.train.small.tsv", sep="\t", 
+            header=None, names=["qid", "pos_pid", "neg_pid"], dtype=np.int32, engine="c")
+        # Pos, Neg, Pos, Neg, ...
+        qids = np.repeat(triples["qid"].values, 2)
+        pids = np.empty(2*len(triples), dtype=np.int32)
+        pids[0::2] = triples["pos_pid"].values
+        pids[1::2] = triples["neg_pid"].values
+        labels = np.tile(np.array([1, 0], dtype=np.int32), len(triples))
+        qrels_df = pd.read_csv(f"{msmarco_dir}/qrels.train.tsv", sep=r"\s+", 
+            header=None, usecols=[0, 2], names=["qid", "pid"], dtype=np.int32, engine="c")
+        qrels_df = qrels_df.drop_duplicates().sort_values(["qid", "pid"])
+        max_qid = max(qrels_df["qid"].max(), qids.max())
+        counts = np.bincount(qrels_df["qid"].values, minlength=max_qid+1)
+        qrel_indptr = np.zeros(max_qid+2, dtype=np.int64)
+        qrel_indptr[1:] = np.cumsum(counts)
+        qrels = Qrels(qrel_indptr, qrels_df["pid"].values)
     else: 
-        for line in open(f"{msmarco_dir}/top1000.{mode}"):
-            qid, pid, _, _ = line.split("\t")
-            qids.append(int(qid))
-            pids.append(int(pid))
-    qrels = dict(qrels)
+        top1000 = pd.read_csv(f"{msmarco_dir}/top1000.{mode}", sep="\t", header=None, 
+            usecols=[0, 1], names=["qid", "pid"], dtype=np.int32, quoting=csv.QUOTE_NONE, engine="c")
+        qids = top1000["qid"].values
+        pids = top1000["pid"].values
     if not mode == "train":
         labels, qrels = None, None
     return qids, pids, labels, qrels
@@ -118,37 +178,46 @@ def load_querydoc_pairs(msmarco_dir, mode):
 class MSMARCODataset(Dataset):
     def __init__(self, mode, msmarco_dir, 
             collection_memmap_dir, tokenize_dir,
-            max_query_length=20, max_doc_length=256, insert_typo=0):
+            max_query_length=20, max_doc_length=256, insert_typo=0,
+            query_memmap_dir="./data/queries_memmap"):
 
         self.collection = CollectionDataset(collection_memmap_dir)
         self.qids, self.pids, self.labels, self.qrels = load_querydoc_pairs(msmarco_dir, mode)
+        if mode != "train":
+            # visit the collection in pid order to stream the memmap instead of random seeks,
+            # scores are written per (qid, pid) so the order of the pairs does not matter
+            order = np.argsort(self.pids, kind="stable")
+            self.qids, self.pids = self.qids[order], self.pids[order]
+            self.collection.advise_sequential()
         self.mode = mode
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", cache_dir=".cache")
+        self.tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased", cache_dir=".cache")
         self.cls_id = self.tokenizer.cls_token_id
         self.sep_id = self.tokenizer.sep_token_id
         self.max_query_length = max_query_length
         self.max_doc_length = max_doc_length
         # self.queries = load_queries(tokenize_dir, mode)
+        self.insert_typo = insert_typo
+        self.query_input_ids = QueryDataset(query_memmap_dir, mode)
+        # fail here rather than in a DataLoader worker halfway through an epoch
+        assert self.query_input_ids.contains(pd.unique(self.qids)).all(), \
+            f"{mode} qids missing from queries.{mode} in {query_memmap_dir}"
         if mode == 'train':
-            self.queries = read_queries(tokenize_dir)
-        elif mode == 'dev':
-            self.queries = read_queries("./data/msmarco-passage/queries.dev.small.tsv")
+            # raw text is only needed to generate typo queries
+            if self.insert_typo == 1:
+                self.queries = read_queries(tokenize_dir)
 
-        self.insert_typo = insert_typo
         if self.insert_typo == 1:
             print("Typo-aware training..")
-            transformation = CompositeTransformation([
-                WordSwapRandomCharacterDeletion(),
-                WordSwapNeighboringCharacterSwap(),
-                WordSwapRandomCharacterInsertion(),
-                WordSwapRandomCharacterSubstitution(),
-                FixWordSwapQWERTY(),
-            ])
-            constraints = [MinWordLength(3)]
-            self.augmenter = Augmenter(transformation=transformation, constraints=constraints, pct_words_to_swap=0)
         else:
             print("No typo-aware training..")
 
+    def get_doc_lengths(self):
+        # [CLS] + doc + [SEP], used to group batches by length. Queries and docs are 
+        # padded separately and the doc tensor dominates, so docs set the sort key
+        doc_lengths = np.minimum(self.collection.lengths[self.pids], self.max_doc_length).astype(np.int32)
+        doc_lengths += 2
+        return doc_lengths
+
     def __len__(self):
         return len(self.qids)
 
@@ -156,59 +225,117 @@ class MSMARCODataset(Dataset):
         qid, pid = self.qids[item], self.pids[item]
         doc_input_ids = self.collection[pid]
 
-        query = self.queries[qid]
-
-        if self.insert_typo == 1:
-            if self.insert_typo and random.random() < 0.5:
-                query = self.augmenter.augment(query)[0]
-
-        tokens = self.tokenizer.tokenize(query)
-        query_input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-
-        query_input_ids = query_input_ids[:self.max_query_length]
-        query_input_ids = [self.cls_id] + query_input_ids + [self.sep_id]
-        doc_input_ids = doc_input_ids[:self.max_doc_length]
-        doc_input_ids = [self.cls_id] + doc_input_ids + [self.sep_id]
+        doc_input_ids = np.concatenate(([self.cls_id], doc_input_ids[:self.max_doc_length], 
+            [self.sep_id])).astype(np.int32)
 
         ret_val = {
-            "query_input_ids": query_input_ids,
             "doc_input_ids": doc_input_ids,
             "qid": qid,
             "docid" : pid
         }
+        if self.insert_typo == 1 and random.random() < 0.5:
+            # the collate function inserts the typo and tokenizes the whole batch at once
+            ret_val["typo_query"] = self.queries[qid]
+        else:
+            query_input_ids = self.query_input_ids[qid][:self.max_query_length]
+            ret_val["query_input_ids"] = np.concatenate(([self.cls_id], query_input_ids, 
+                [self.sep_id])).astype(np.int32)
         if self.mode == "train":
-            ret_val["rel_docs"] = self.qrels[qid]
+            ret_val["rel_docs"] = self.qrels.indices[
+                self.qrels.indptr[qid]:self.qrels.indptr[qid+1]]
         return ret_val
 
 
 def pack_tensor_2D(lstlst, default, dtype, length=None):
-    batch_size = len(lstlst)
-    length = length if length is not None else max(len(l) for l in lstlst)
-    tensor = default * torch.ones((batch_size, length), dtype=dtype)
-    for i, l in enumerate(lstlst):
-        tensor[i, :len(l)] = torch.tensor(l, dtype=dtype)
+    lengths = torch.tensor([len(l) for l in lstlst])
+    length = length if length is not None else lengths.max().item()
+    # widen to int64 on the numpy side (a no-op for int64 rows) so from_numpy wraps the 
+    # flat buffer without a further copy, then scatter it into the padded tensor in one op
+    flat = torch.from_numpy(np.concatenate(lstlst).astype(np.int64, copy=False)).to(dtype)
+    tensor = torch.full((len(lstlst), length), default, dtype=dtype)
+    tensor[torch.arange(length)[None, :] < lengths[:, None]] = flat
     return tensor
 
 
-def get_collate_function(mode):
+class LengthGroupedSampler(Sampler):
+    """
+    Shuffles the data, then sorts every mega batch by length so that each batch 
+    only pads to the length of similar examples. `group_size` consecutive examples 
+    (e.g., a pos/neg pair of the train triples) always stay in the same batch.
+    """
+    def __init__(self, batch_size, lengths, group_size=1, mega_batch_mult=50):
+        assert batch_size % group_size == 0
+        self.group_size = group_size
+        self.groups_per_batch = batch_size // group_size
+        self.mega_batch_size = self.groups_per_batch * mega_batch_mult
+        lengths = np.asarray(lengths)
+        num_groups = len(lengths) // group_size
+        self.group_lengths = lengths[:num_groups*group_size].reshape(num_groups, group_size).max(axis=1)
+
+    def __len__(self):
+        return len(self.group_lengths) * self.group_size
+
+    def __iter__(self):
+        groups = torch.randperm(len(self.group_lengths)).numpy()
+        batches = []
+        for start in range(0, len(groups), self.mega_batch_size):
+            mega_batch = groups[start:start+self.mega_batch_size]
+            mega_batch = mega_batch[np.argsort(-self.group_lengths[mega_batch], kind="stable")]
+            batches.extend(mega_batch[i:i+self.groups_per_batch] 
+                for i in range(0, len(mega_batch), self.groups_per_batch))
+        # a trailing incomplete batch stays last, otherwise it would shift every following batch
+        num_full_batches = len(groups) // self.groups_per_batch
+        order = torch.randperm(num_full_batches).tolist() + list(range(num_full_batches, len(batches)))
+        for batch_idx in order:
+            for group in batches[batch_idx]:
+                yield from range(group*self.group_size, (group+1)*self.group_size)
+
+
+def pack_valid_mask(lstlst):
+    lengths = torch.tensor([len(l) for l in lstlst])
+    positions = torch.arange(lengths.max().item())
+    return (positions[None, :] < lengths[:, None]).long()
+
+
+def get_collate_function(mode, tokenizer=None, max_query_length=20):
+    typo_rngs = dict()
     def collate_function(batch):
-        input_ids_lst = [x["query_input_ids"] + x["doc_input_ids"] for x in batch]
-        token_type_ids_lst = [[0]*len(x["query_input_ids"]) + [1]*len(x["doc_input_ids"]) 
-            for x in batch]
-        valid_mask_lst = [[1]*len(input_ids) for input_ids in input_ids_lst]
-        position_ids_lst = [list(range(len(x["query_input_ids"]))) + 
-            list(range(len(x["doc_input_ids"]))) for x in batch]
+        typo_batch = [x for x in batch if "typo_query" in x]
+        if len(typo_batch) > 0:
+            # one generator per DataLoader worker, created on first use and seeded
+            # from the worker's torch seed so that workers draw different typos
+            pid = os.getpid()
+            if pid not in typo_rngs:
+                typo_rngs[pid] = random.Random(torch.initial_seed())
+            typo_queries = [apply_random_typo(x["typo_query"], typo_rngs[pid]) for x in typo_batch]
+            typo_input_ids = tokenizer(typo_queries, add_special_tokens=False,
+                truncation=True, max_length=max_query_length,
+                return_attention_mask=False, return_token_type_ids=False)["input_ids"]
+            for x, query_input_ids in zip(typo_batch, typo_input_ids):
+                x["query_input_ids"] = np.array([tokenizer.cls_token_id] + query_input_ids + 
+                    [tokenizer.sep_token_id], dtype=np.int32)
+        query_input_ids_lst = [x["query_input_ids"] for x in batch]
+        doc_input_ids_lst = [x["doc_input_ids"] for x in batch]
         data = {
-            "input_ids": pack_tensor_2D(input_ids_lst, default=0, dtype=torch.int64),
-            "token_type_ids": pack_tensor_2D(token_type_ids_lst, default=0, dtype=torch.int64),
-            "valid_mask": pack_tensor_2D(valid_mask_lst, default=0, dtype=torch.int64),
-            "position_ids": pack_tensor_2D(position_ids_lst, default=0, dtype=torch.int64),
+            "query_input_ids": pack_tensor_2D(query_input_ids_lst, default=0, dtype=torch.int64),
+            "query_valid_mask": pack_valid_mask(query_input_ids_lst),
+            "doc_input_ids": pack_tensor_2D(doc_input_ids_lst, default=0, dtype=torch.int64),
+            "doc_valid_mask": pack_valid_mask(doc_input_ids_lst),
         }
         qid_lst = [x['qid'] for x in batch]
         docid_lst = [x['docid'] for x in batch]
         if mode == "train":
-            labels = [[j for j in range(len(docid_lst)) if docid_lst[j] in x['rel_docs'] ]for x in batch]
-            data['labels'] =  pack_tensor_2D(labels, default=-1, dtype=torch.int64, length=len(batch))
+            docids = np.asarray(docid_lst, dtype=np.int64)
+            rel_docs = np.concatenate([x['rel_docs'] for x in batch]).astype(np.int64)
+            rel_rows = np.repeat(np.arange(len(batch)), [len(x['rel_docs']) for x in batch])
+            # a single membership test on (row, docid) keys for the whole batch
+            stride = max(docids.max(), rel_docs.max(initial=0)) + 1
+            is_rel = np.isin(np.arange(len(batch))[:, None] * stride + docids[None, :], 
+                rel_rows * stride + rel_docs)
+            # MultiLabelMarginLoss expects the relevant indices first, then -1
+            order = np.argsort(~is_rel, axis=1, kind="stable")
+            labels = np.where(np.take_along_axis(is_rel, order, axis=1), order, -1)
+            data['labels'] = torch.from_numpy(labels)
         return data, qid_lst, docid_lst
     return collate_function  
 
@@ -216,9 +343,9 @@ def get_collate_function(mode):
 def _test_dataset():
     dataset = MSMARCODataset(mode="train")
     for data in dataset:
-        tokens = dataset.tokenizer.convert_ids_to_tokens(data["query_input_ids"])
+        tokens = dataset.tokenizer.convert_ids_to_tokens(data["query_input_ids"].tolist())
         print(tokens)
-        tokens = dataset.tokenizer.convert_ids_to_tokens(data["doc_input_ids"])
+        tokens = dataset.tokenizer.convert_ids_to_tokens(data["doc_input_ids"].tolist())
         print(tokens)
         print(data['qid'], data['docid'], data['rel_docs'])
         print()
@@ -231,17 +358,18 @@ def _test_collate_func():
     from torch.utils.data import DataLoader, SequentialSampler
     eval_dataset = MSMARCODataset(mode="train")   
     train_sampler = SequentialSampler(eval_dataset)  
-    collate_fn = get_collate_function(mode="train")
+    collate_fn = get_collate_function(mode="train", tokenizer=eval_dataset.tokenizer)
     dataloader = DataLoader(eval_dataset, batch_size=26,
-        num_workers=4, collate_fn=collate_fn, sampler=train_sampler)
+        num_workers=4, collate_fn=collate_fn, sampler=train_sampler,
+        persistent_workers=True, prefetch_factor=4, pin_memory=True)
     tokenizer = eval_dataset.tokenizer
     for batch, qidlst, pidlst in tqdm(dataloader):
         pass
         '''
-        print(batch['input_ids'])
-        print(batch['token_type_ids'])
-        print(batch['valid_mask'])
-        print(batch['position_ids'])
+        print(batch['query_input_ids'])
+        print(batch['query_valid_mask'])
+        print(batch['doc_input_ids'])
+        print(batch['doc_valid_mask'])
         print(batch['labels'])
         k = input()
         if k == "q":
@@ -7,50 +7,26 @@ from transformers import (BertModel, BertPreTrainedModel)
 logger = logging.getLogger(__name__)
 
 
-def _average_query_doc_embeddings(sequence_output, token_type_ids, valid_mask):
-    query_flags = (token_type_ids==0)*(valid_mask==1)
-    doc_flags = (token_type_ids==1)*(valid_mask==1)
-
-    query_lengths = torch.sum(query_flags, dim=-1)
-    query_lengths = torch.clamp(query_lengths, 1, None)
-    doc_lengths = torch.sum(doc_flags, dim=-1)
-    doc_lengths = torch.clamp(doc_lengths, 1, None)
-    
-    query_embeddings = torch.sum(sequence_output * query_flags[:,:,None], dim=1)
-    query_embeddings = query_embeddings/query_lengths[:, None]
-    doc_embeddings = torch.sum(sequence_output * doc_flags[:,:,None], dim=1)
-    doc_embeddings = doc_embeddings/doc_lengths[:, None]
-    return query_embeddings, doc_embeddings
-
-
-def _mask_both_directions(valid_mask, token_type_ids):
-    assert valid_mask.dim() == 2
-    attention_mask = valid_mask[:, None, :]
-
-    type_attention_mask = torch.abs(token_type_ids[:, :, None] - token_type_ids[:, None, :])
-    attention_mask = attention_mask - type_attention_mask
-    attention_mask = torch.clamp(attention_mask, 0, None)
-    return attention_mask
-
-
 class RepBERT_Train(BertPreTrainedModel):
     def __init__(self, config):
         super(RepBERT_Train, self).__init__(config)
         self.bert = BertModel(config)
         self.init_weights()
 
-    def forward(self, input_ids, token_type_ids, valid_mask,
-                position_ids, labels=None):
-        attention_mask = _mask_both_directions(valid_mask, token_type_ids)
-
+    def _encode(self, input_ids, valid_mask, token_type_ids):
         sequence_output = self.bert(input_ids,
-                            attention_mask=attention_mask,
-                            token_type_ids=token_type_ids,
-                            position_ids=position_ids)[0]
-        
-        query_embeddings, doc_embeddings = _average_query_doc_embeddings(
-            sequence_output, token_type_ids, valid_mask
-        )
+                            attention_mask=valid_mask,
+                            token_type_ids=token_type_ids)[0]
+        return _average_sequence_embeddings(sequence_output, valid_mask)
+
+    def forward(self, query_input_ids, query_valid_mask,
+                doc_input_ids, doc_valid_mask, labels=None):
+        # queries and docs never attend to each other, so encode them as two
+        # separately padded batches instead of one concatenated sequence
+        query_embeddings = self._encode(query_input_ids, query_valid_mask,
+            torch.zeros_like(query_input_ids))
+        doc_embeddings = self._encode(doc_input_ids, doc_valid_mask,
+            torch.ones_like(doc_input_ids))
         
         similarities = torch.matmul(query_embeddings, doc_embeddings.T)
         
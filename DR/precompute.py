@@ -10,7 +10,8 @@ from timeit import default_timer as timer
 from collections import namedtuple, defaultdict
 from transformers import BertTokenizer, BertConfig
 from torch.utils.data import DataLoader, Dataset
-from dataset import (load_querydoc_pairs, load_queries, CollectionDataset, pack_tensor_2D, MSMARCODataset)
+from dataset import (load_querydoc_pairs, load_queries, CollectionDataset, pack_tensor_2D, 
+    pack_valid_mask, MSMARCODataset)
 from modeling import RepBERT
 
 logger = logging.getLogger(__name__)
@@ -81,8 +82,8 @@ class MSMARCO_DocDataset(Dataset):
     def __getitem__(self, item):
         pid = self.pids[item]
         doc_input_ids = self.collection[pid]
-        doc_input_ids = doc_input_ids[:self.max_doc_length]
-        doc_input_ids = [self.cls_id] + doc_input_ids + [self.sep_id]
+        doc_input_ids = np.concatenate(([self.cls_id], doc_input_ids[:self.max_doc_length], 
+            [self.sep_id])).astype(np.int32)
 
         ret_val = {
             "input_ids": doc_input_ids,
@@ -94,12 +95,10 @@ class MSMARCO_DocDataset(Dataset):
 def get_collate_function():
     def collate_function(batch):
         input_ids_lst = [x["input_ids"] for x in batch]
-        valid_mask_lst = [[1]*len(input_ids) for input_ids in input_ids_lst]
         data = {
             "input_ids": pack_tensor_2D(input_ids_lst, default=0, 
                 dtype=torch.int64),
-            "valid_mask": pack_tensor_2D(valid_mask_lst, default=0, 
-                dtype=torch.int64),
+            "valid_mask": pack_valid_mask(input_ids_lst),
         }
         id_lst = [x['id'] for x in batch]
         return data, id_lst
@@ -122,7 +121,8 @@ def generate_embeddings(args, model, task):
     batch_size = args.per_gpu_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
     collate_fn = get_collate_function()
-    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, 
+        pin_memory=args.device.type == "cuda")
 
     # multi-gpu eval
     if args.n_gpu > 1:
@@ -135,7 +135,7 @@ def generate_embeddings(args, model, task):
     for batch, ids in tqdm(dataloader, desc="Evaluating"):
         model.eval()
         with torch.no_grad():
-            batch = {k:v.to(args.device) for k, v in batch.items()}
+            batch = {k:v.to(args.device, non_blocking=True) for k, v in batch.items()}
             output = model(**batch)
             sequence_embeddings = output.detach().cpu().numpy()
             poses = [id2pos[identity] for identity in ids]
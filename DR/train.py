@@ -15,7 +15,7 @@ from torch.utils.data import DataLoader, SequentialSampler
 from transformers import (BertConfig, BertTokenizer, AdamW, get_linear_schedule_with_warmup)
 
 from modeling import RepBERT_Train
-from dataset import MSMARCODataset, get_collate_function
+from dataset import MSMARCODataset, LengthGroupedSampler, get_collate_function
 from utils import generate_rank, eval_results
 
 
@@ -50,14 +50,24 @@ def train(args, model):
 
     train_dataset = MSMARCODataset("train", args.msmarco_dir, 
             args.collection_memmap_dir, args.tokenize_dir,
-            args.max_query_length, args.max_doc_length, args.insert_typo)
-
-    # NOTE: Must Sequential! Pos, Neg, Pos, Neg, ...
-    train_sampler = SequentialSampler(train_dataset) 
-    collate_fn = get_collate_function(mode="train")
+            args.max_query_length, args.max_doc_length, args.insert_typo,
+            query_memmap_dir=args.query_memmap_dir)
+
+    # NOTE: Pos, Neg, Pos, Neg, ... pairs must stay adjacent in the same batch, 
+    # either sequential or length grouped with group_size=2
+    if args.group_by_length:
+        train_sampler = LengthGroupedSampler(args.train_batch_size, 
+            train_dataset.get_doc_lengths(), group_size=2)
+    else:
+        train_sampler = SequentialSampler(train_dataset) 
+    collate_fn = get_collate_function(mode="train", tokenizer=train_dataset.tokenizer,
+        max_query_length=args.max_query_length)
+    # keep workers (and their warm memmap pages) alive across epochs
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) \
+        if args.data_num_workers > 0 else {}
     train_dataloader = DataLoader(train_dataset, sampler=train_sampler, 
         batch_size=args.train_batch_size, num_workers=args.data_num_workers, 
-        collate_fn=collate_fn)
+        collate_fn=collate_fn, pin_memory=args.device.type == "cuda", **worker_kwargs)
 
     t_total = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
 
@@ -94,7 +104,7 @@ def train(args, model):
         epoch_iterator = tqdm(train_dataloader, desc="Iteration")
         for step, (batch, _, _) in enumerate(epoch_iterator):
 
-            batch = {k:v.to(args.device) for k, v in batch.items()}
+            batch = {k:v.to(args.device, non_blocking=True) for k, v in batch.items()}
             model.train()            
             outputs = model(**batch)
             loss = outputs[0]  # model outputs are always tuple in pytorch-transformers (see doc)
@@ -133,13 +143,15 @@ def evaluate(args, model, mode, prefix):
   
     eval_dataset = MSMARCODataset(mode, args.msmarco_dir, 
             args.collection_memmap_dir, args.tokenize_dir,
-            args.max_query_length, args.max_doc_length)
+            args.max_query_length, args.max_doc_length, 
+            query_memmap_dir=args.query_memmap_dir)
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
     collate_fn = get_collate_function(mode=mode)
     eval_dataloader = DataLoader(eval_dataset, batch_size=args.eval_batch_size,
-        num_workers=args.data_num_workers, collate_fn=collate_fn)
+        num_workers=args.data_num_workers, collate_fn=collate_fn, 
+        pin_memory=args.device.type == "cuda")
 
     # multi-gpu eval
     if args.n_gpu > 1:
@@ -155,7 +167,7 @@ def evaluate(args, model, mode, prefix):
         for batch, qids, docids in tqdm(eval_dataloader, desc="Evaluating"):
             model.eval()
             with torch.no_grad():
-                batch = {k:v.to(args.device) for k, v in batch.items()}
+                batch = {k:v.to(args.device, non_blocking=True) for k, v in batch.items()}
                 outputs = model(**batch)
                 scores = torch.diagonal(outputs[0]).detach().cpu().numpy()
                 assert len(qids) == len(docids) == len(scores)
@@ -182,6 +194,7 @@ def run_parse_args():
     parser.add_argument("--collection_memmap_dir", type=str, default="./data/collection_memmap")
     # parser.add_argument("--tokenize_dir", type=str, default="./data/tokenize")
     parser.add_argument("--tokenize_dir", type=str, default="./data/msmarco-passage/queries.train.tsv")
+    parser.add_argument("--query_memmap_dir", type=str, default="./data/queries_memmap")
     parser.add_argument("--max_query_length", type=int, default=20)
     parser.add_argument("--max_doc_length", type=int, default=256)
 
@@ -208,6 +221,7 @@ def run_parse_args():
     parser.add_argument("--max_grad_norm", default=1.0, type=float)
     parser.add_argument("--num_train_epochs", default=1, type=int)
     parser.add_argument("--insert_typo", default=0, type=int)
+    parser.add_argument("--group_by_length", action="store_true")
 
     args = parser.parse_args()
 